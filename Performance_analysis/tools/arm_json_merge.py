@@ -73,11 +73,25 @@ def usage():
     exit(2)
 
 
+def mergedTid(id, tid):
+    # main context keeps file name, other contexts (cores, exception handlers)
+    # are kept on separate tracks
+    if tid == 1:
+        return id
+    return "%s:%s" % (id, tid)
+
+
 def filterAndAjustGen(dic, ts, dur, id):
     for obj in dic:
-        if obj["ts"] >= ts and obj["ts"] <= ts + dur:
+        if obj.get("ph") == "M":
+            # track names metadata
+            obj["tid"] = mergedTid(id, obj.get("tid", 1))
+            if "name" in obj.get("args", {}):
+                obj["args"]["name"] = "%s %s" % (id, obj["args"]["name"])
+            yield obj
+        elif obj["ts"] >= ts and obj["ts"] <= ts + dur:
             obj["ts"] = obj["ts"] - ts
-            obj["tid"] = id
+            obj["tid"] = mergedTid(id, obj.get("tid", 1))
             yield obj
 
 
@@ -38,6 +38,15 @@ import sys
 import re
 import os
 import signal
+import stat
+import time
+import codecs
+import select
+import threading
+import http.server
+import json
+import struct
+import bisect
 from collections import defaultdict
 
 # globals
@@ -45,6 +54,11 @@ abort = False
 verbose = False
 coverageDetails = False
 
+# live follow mode
+liveSnapshot = ""
+followPollDelay = 0.2
+snapshotTopCount = 30
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Regexp's
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -61,11 +75,13 @@ fromelfPartial1Re = re.compile(r"\s+[0-9]+\s+([a-zA-Z0-9_\.]+)\s*$")
 fromelfPartial2Re = re.compile(r"\s+(0x[0-9a-fA-F]+)\s+.*Code\s+.*(0x[0-9a-fA-F]+)")
 
 # MDK ETM CSV trace
-parseMdkEtmRe = re.compile('"[0-9a-fA-F]+","(.*)",X : 0x([0-9a-fA-F]+),.*,"(.*)"')
+parseMdkEtmRe = re.compile(
+    '"[0-9a-fA-F]+","(?P<time>.*)",X : 0x(?P<pc>[0-9a-fA-F]+),.*,"(?P<instr>.*)"'
+)
 
-# FVP/VHT/IPSS
+# FVP/VHT/IPSS (with core name and thread / handler execution mode)
 parseFVPRe = re.compile(
-    "([0-9]+)\s+ps.*IT\s+\(.*\)\s+([0-9a-fA-F]+)\s+([0-9a-fA-F]+)\s+T\s+(thread|hdlr).*\s+(.*)"
+    "(?P<time>[0-9]+)\s+ps\s*(?P<cpu>.*?)\s*IT\s+\(.*\)\s+(?P<pc>[0-9a-fA-F]+)\s+(?P<instr>[0-9a-fA-F]+)\s+T\s+(?P<mode>thread|hdlr).*\s+(.*)"
 )
 
 # discard functions starting with $
@@ -84,6 +100,20 @@ sclSTRe = re.compile(".*\:\s+V?ST.*")
 pushRe = re.compile(".*\:\s+V?PUSH.*")
 popRe = re.compile(".*\:\s+V?POP.*")
 
+# exception handlers (CMSIS naming) and handler return instructions
+handlerRe = re.compile(r".*Handler$")
+excReturnRe = re.compile(r".*:\s+(BX\s+lr|POP(\.W)?\s+\{.*pc\}|LDR(\.W)?\s+pc)", re.IGNORECASE)
+branchRe = re.compile(
+    r".*:\s+(BL|BLX|BX|B|CBN?Z|B(EQ|NE|CS|CC|HS|LO|MI|PL|VS|VC|HI|LS|GE|LT|GT|LE))(\.[WN])?\s+(?P<dest>.*)",
+    re.IGNORECASE,
+)
+pcRelRe = re.compile(r".*\{pc\}\s*(?P<off>[+-]\s*(0x)?[0-9a-fA-F]+)")
+absDestRe = re.compile(r"^(0x[0-9a-fA-F]+)\s*$")
+
+# loop analysis : low overhead loop end and Helium (Q register) instructions
+loopEndRe = re.compile(r".*\:\s+(LETP|LE)\s")
+vecInstRe = re.compile(r".*\:\s+V\S*\s.*\b[qQ][0-7]\b")
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # functions
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -117,6 +147,995 @@ def keyAbort(signum, frame):
     abort = True
 
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# live follow : tail a growing tarmac file or named pipe
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def followLines(fileName):
+    # yields complete lines as they get appended to the trace
+    # None is yielded when no new data is available (or on CTRL+C) so that
+    # the caller can refresh the live snapshot or stop
+    isFifo = stat.S_ISFIFO(os.stat(fileName).st_mode)
+    if isFifo:
+        # do not block until a writer opens the pipe, so that CTRL+C still
+        # stops the tool while waiting for the simulation to start
+        fd = os.open(fileName, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(fd, True)
+    else:
+        fd = os.open(fileName, os.O_RDONLY)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    partial = ""
+    connected = False
+
+    try:
+        while True:
+            if abort:
+                yield None
+                break
+
+            if isFifo:
+                if not select.select([fd], [], [], followPollDelay)[0]:
+                    yield None
+                    continue
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                # writer closed the pipe
+                if isFifo and connected:
+                    break
+                yield None
+                time.sleep(followPollDelay)
+                continue
+            connected = True
+
+            lines = (partial + decoder.decode(chunk)).split("\n")
+            # keep incomplete line until the rest gets written
+            partial = lines.pop()
+            for line in lines:
+                yield line + "\n"
+    finally:
+        os.close(fd)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# coverage statistics for a function
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def coverageStats(instSet):
+    cov = 0
+    t16 = 0
+    t32 = 0
+
+    for pc, s in instSet:
+        if s == 2:
+            cov += 2
+            t16 += 1
+        elif s == 4:
+            cov += 4
+            t32 += 1
+        else:
+            print(f"error len={s}")
+
+    return (cov, t16, t32)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# live snapshot : rolling flat profile and coverage summary
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def formatSnapshot(
+    funcCallCnt,
+    funcSelfTime,
+    funcTotalTime,
+    funcTotalInstr,
+    prevSelfTime,
+    codecov_dict,
+    lineCnt,
+    clock,
+):
+    totalSelf = sum(funcSelfTime.values())
+    windowSelf = totalSelf - sum(prevSelfTime.values())
+
+    snap = "# lines %d, time %f\n\n" % (lineCnt, clock)
+    snap += "function, calls, self time, self (%), window (%), total time, instructions count\n"
+
+    hot = sorted(funcSelfTime.items(), key=lambda x: x[1], reverse=True)
+    for sym, selfTime in hot[:snapshotTopCount]:
+        if selfTime == 0:
+            break
+        window = selfTime - prevSelfTime.get(sym, 0)
+        snap += "%s, %d, %f, %.2f, %.2f, %f, %d\n" % (
+            sym.strip(),
+            funcCallCnt[sym],
+            selfTime,
+            100 * selfTime / totalSelf,
+            100 * window / windowSelf if windowSelf else 0,
+            funcTotalTime[sym],
+            funcTotalInstr[sym],
+        )
+
+    snap += "\nfunc, size, size covered, coverage (%)\n"
+    for key, value in codecov_dict.items():
+        if bool(value[2]) and value[1] > 8:
+            (cov, t16, t32) = coverageStats(value[2])
+            snap += "%s, %d, %d, %.2f\n" % (
+                key,
+                value[1],
+                cov,
+                100 * float(cov) / float(value[1]),
+            )
+
+    return snap
+
+
+def writeSnapshot(fileName, snap):
+    global liveSnapshot
+    liveSnapshot = snap
+
+    if fileName is None:
+        return
+
+    # write aside and rename so that readers never see a partial snapshot
+    tmpName = fileName + ".tmp"
+    with open(tmpName, "w") as snapFile:
+        snapFile.write(snap)
+    os.replace(tmpName, fileName)
+
+
+class SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = liveSnapshot.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startSnapshotServer(port):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), SnapshotHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    printf("Live profile served on http://127.0.0.1:%d/\n", port)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# ELF section extraction
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SHF_EXECINSTR = 0x4
+
+
+def readElfSections(fileName, names):
+    # returns {name: bytes} for the requested sections found in the image,
+    # the (address, size) ranges of the executable sections and the
+    # struct byte order prefix
+    with open(fileName, "rb") as elf:
+        image = elf.read()
+
+    if image[:4] != b"\x7fELF":
+        return (None, [], "<")
+
+    is64 = image[4] == 2
+    endian = ">" if image[5] == 2 else "<"
+
+    if is64:
+        (shoff,) = struct.unpack_from(endian + "Q", image, 0x28)
+        (shentsize, shnum, shstrndx) = struct.unpack_from(endian + "HHH", image, 0x3A)
+        shFmt = endian + "IIQQQQ"
+    else:
+        (shoff,) = struct.unpack_from(endian + "I", image, 0x20)
+        (shentsize, shnum, shstrndx) = struct.unpack_from(endian + "HHH", image, 0x2E)
+        shFmt = endian + "IIIIII"
+
+    headers = [
+        struct.unpack_from(shFmt, image, shoff + i * shentsize) for i in range(shnum)
+    ]
+    (_, _, _, _, strOffset, strSize) = headers[shstrndx]
+    shstrtab = image[strOffset : strOffset + strSize]
+
+    sections = {}
+    codeRanges = []
+    for nameOffset, shType, flags, addr, offset, size in headers:
+        name = shstrtab[nameOffset : shstrtab.index(b"\0", nameOffset)].decode()
+        if name in names:
+            sections[name] = image[offset : offset + size]
+        if flags & SHF_EXECINSTR and size:
+            codeRanges.append((addr, size))
+
+    return (sections, codeRanges, endian)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# DWARF .debug_line decoding (version 2 to 5)
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def readUleb(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return (result, pos)
+
+
+def readSleb(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return (result, pos)
+
+
+def readCString(data, pos):
+    end = data.index(b"\0", pos)
+    return (data[pos:end].decode("utf-8", errors="replace"), end + 1)
+
+
+def readLineEntryFormat(data, pos, endian, offSize, formats, strSections):
+    # DWARF 5 directory / file name entry described by (content type, form) pairs
+    entry = {}
+    for contentType, form in formats:
+        if form == 0x08:  # DW_FORM_string
+            (value, pos) = readCString(data, pos)
+        elif form in (0x0E, 0x1F):  # DW_FORM_strp, DW_FORM_line_strp
+            (strOffset,) = struct.unpack_from(
+                endian + ("Q" if offSize == 8 else "I"), data, pos
+            )
+            pos += offSize
+            strSection = strSections.get(".debug_str" if form == 0x0E else ".debug_line_str", b"")
+            (value, _) = readCString(strSection, strOffset)
+        elif form == 0x0F:  # DW_FORM_udata
+            (value, pos) = readUleb(data, pos)
+        elif form == 0x0B:  # DW_FORM_data1
+            value = data[pos]
+            pos += 1
+        elif form == 0x05:  # DW_FORM_data2
+            (value,) = struct.unpack_from(endian + "H", data, pos)
+            pos += 2
+        elif form == 0x06:  # DW_FORM_data4
+            (value,) = struct.unpack_from(endian + "I", data, pos)
+            pos += 4
+        elif form == 0x07:  # DW_FORM_data8
+            (value,) = struct.unpack_from(endian + "Q", data, pos)
+            pos += 8
+        elif form == 0x1E:  # DW_FORM_data16
+            value = None
+            pos += 16
+        elif form == 0x09:  # DW_FORM_block
+            (size, pos) = readUleb(data, pos)
+            value = None
+            pos += size
+        else:
+            raise ValueError("unsupported DWARF form 0x%x" % form)
+        entry[contentType] = value
+    return (entry, pos)
+
+
+def inCodeRanges(address, codeRanges):
+    if not codeRanges:
+        # no section information, only discard sequences left at 0 by the linker
+        return address != 0
+    for base, size in codeRanges:
+        if base <= address < base + size:
+            return True
+    return False
+
+
+def parseDebugLine(data, endian, strSections, codeRanges):
+    # returns a list of (address, file, line) rows, file being None
+    # for end of sequence markers
+    # sequences of code discarded by the linker (not starting in an
+    # executable section) are dropped
+    rows = []
+    pos = 0
+
+    while pos < len(data):
+        (unitLength,) = struct.unpack_from(endian + "I", data, pos)
+        pos += 4
+        offSize = 4
+        if unitLength == 0xFFFFFFFF:
+            (unitLength,) = struct.unpack_from(endian + "Q", data, pos)
+            pos += 8
+            offSize = 8
+        unitEnd = pos + unitLength
+
+        (version,) = struct.unpack_from(endian + "H", data, pos)
+        pos += 2
+        if version < 2 or version > 5:
+            printf("unsupported .debug_line version %d\n", version)
+            pos = unitEnd
+            continue
+
+        if version >= 5:
+            addrSize = data[pos]
+            pos += 2
+        else:
+            addrSize = None
+
+        (headerLength,) = struct.unpack_from(
+            endian + ("Q" if offSize == 8 else "I"), data, pos
+        )
+        pos += offSize
+        progStart = pos + headerLength
+
+        minInstLength = data[pos]
+        pos += 1
+        if version >= 4:
+            pos += 1  # maximum_operations_per_instruction (VLIW only)
+        defaultIsStmt = data[pos]
+        (lineBase,) = struct.unpack_from("b", data, pos + 1)
+        lineRange = data[pos + 2]
+        opcodeBase = data[pos + 3]
+        pos += 4
+        stdOpcodeLengths = data[pos : pos + opcodeBase - 1]
+        pos += opcodeBase - 1
+
+        if version >= 5:
+            dirFormats = []
+            formatCount = data[pos]
+            pos += 1
+            for i in range(formatCount):
+                (contentType, pos) = readUleb(data, pos)
+                (form, pos) = readUleb(data, pos)
+                dirFormats.append((contentType, form))
+            (dirCount, pos) = readUleb(data, pos)
+            dirs = []
+            for i in range(dirCount):
+                (entry, pos) = readLineEntryFormat(
+                    data, pos, endian, offSize, dirFormats, strSections
+                )
+                dirs.append(entry.get(1, ""))
+
+            fileFormats = []
+            formatCount = data[pos]
+            pos += 1
+            for i in range(formatCount):
+                (contentType, pos) = readUleb(data, pos)
+                (form, pos) = readUleb(data, pos)
+                fileFormats.append((contentType, form))
+            (fileCount, pos) = readUleb(data, pos)
+            files = []
+            for i in range(fileCount):
+                (entry, pos) = readLineEntryFormat(
+                    data, pos, endian, offSize, fileFormats, strSections
+                )
+                dirIdx = entry.get(2, 0)
+                files.append(
+                    os.path.join(dirs[dirIdx] if dirIdx < len(dirs) else "", entry.get(1, ""))
+                )
+        else:
+            # index 0 is the compilation directory / primary source file
+            dirs = [""]
+            while data[pos] != 0:
+                (name, pos) = readCString(data, pos)
+                dirs.append(name)
+            pos += 1
+
+            files = [""]
+            while data[pos] != 0:
+                (name, pos) = readCString(data, pos)
+                (dirIdx, pos) = readUleb(data, pos)
+                (mtime, pos) = readUleb(data, pos)
+                (size, pos) = readUleb(data, pos)
+                files.append(os.path.join(dirs[dirIdx] if dirIdx < len(dirs) else "", name))
+
+        # line number program state machine
+        pos = progStart
+        address = 0
+        fileIdx = 1
+        line = 1
+        seq = []
+
+        while pos < unitEnd:
+            opcode = data[pos]
+            pos += 1
+
+            if opcode >= opcodeBase:
+                # special opcode
+                adjusted = opcode - opcodeBase
+                address += (adjusted // lineRange) * minInstLength
+                line += lineBase + adjusted % lineRange
+                seq.append((address, files[fileIdx] if fileIdx < len(files) else "?", line))
+            elif opcode == 0:
+                # extended opcode
+                (length, pos) = readUleb(data, pos)
+                subOpcode = data[pos]
+                if subOpcode == 1:  # DW_LNE_end_sequence
+                    seq.append((address, None, 0))
+                    if inCodeRanges(seq[0][0], codeRanges):
+                        rows += seq
+                    seq = []
+                    address = 0
+                    fileIdx = 1
+                    line = 1
+                elif subOpcode == 2:  # DW_LNE_set_address
+                    size = addrSize or length - 1
+                    address = int.from_bytes(
+                        data[pos + 1 : pos + 1 + size],
+                        "big" if endian == ">" else "little",
+                    )
+                elif subOpcode == 3:  # DW_LNE_define_file
+                    (name, _) = readCString(data, pos + 1)
+                    files.append(name)
+                pos += length
+            elif opcode == 1:  # DW_LNS_copy
+                seq.append((address, files[fileIdx] if fileIdx < len(files) else "?", line))
+            elif opcode == 2:  # DW_LNS_advance_pc
+                (delta, pos) = readUleb(data, pos)
+                address += delta * minInstLength
+            elif opcode == 3:  # DW_LNS_advance_line
+                (delta, pos) = readSleb(data, pos)
+                line += delta
+            elif opcode == 4:  # DW_LNS_set_file
+                (fileIdx, pos) = readUleb(data, pos)
+            elif opcode == 8:  # DW_LNS_const_add_pc
+                address += ((255 - opcodeBase) // lineRange) * minInstLength
+            elif opcode == 9:  # DW_LNS_fixed_advance_pc
+                (delta,) = struct.unpack_from(endian + "H", data, pos)
+                pos += 2
+                address += delta
+            else:
+                # column, stmt, basic block, prologue/epilogue, isa, ...
+                for i in range(stdOpcodeLengths[opcode - 1]):
+                    (arg, pos) = readUleb(data, pos)
+
+        # unterminated sequence
+        if seq and inCodeRanges(seq[0][0], codeRanges):
+            rows += seq
+
+        pos = unitEnd
+
+    return rows
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# PC to source line table
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# bumped when the cached table content changes
+LINE_CACHE_VERSION = 2
+
+
+def buildLineTable(axfName):
+    # sorted (address, line index) table + unique (file, line) list
+    # cached next to the image and rebuilt when the image changes
+    cacheName = axfName + ".lines"
+    imageStat = os.stat(axfName)
+    imageId = [LINE_CACHE_VERSION, imageStat.st_size, imageStat.st_mtime]
+
+    try:
+        with open(cacheName, "r") as cacheFile:
+            cache = json.load(cacheFile)
+        if cache["image"] == imageId:
+            return (cache["addr"], cache["idx"], [tuple(l) for l in cache["lines"]])
+    except (IOError, ValueError, KeyError):
+        pass
+
+    (sections, codeRanges, endian) = readElfSections(
+        axfName, (".debug_line", ".debug_str", ".debug_line_str")
+    )
+    if sections is None or ".debug_line" not in sections:
+        printf("No .debug_line section found in %s\n", axfName)
+        return None
+
+    rows = parseDebugLine(sections[".debug_line"], endian, sections, codeRanges)
+    rows.sort(key=lambda x: x[0])
+
+    lineAddr = []
+    lineIdx = []
+    lines = []
+    lineIds = {}
+    for address, fileName, line in rows:
+        if fileName is None:
+            idx = -1
+        else:
+            key = (fileName, line)
+            idx = lineIds.get(key)
+            if idx is None:
+                idx = len(lines)
+                lineIds[key] = idx
+                lines.append(key)
+
+        if lineAddr and lineAddr[-1] == address:
+            # several rows for the same address : last one wins,
+            # but never let an end of sequence hide a real entry
+            if idx != -1:
+                lineIdx[-1] = idx
+            continue
+        lineAddr.append(address)
+        lineIdx.append(idx)
+
+    try:
+        with open(cacheName, "w") as cacheFile:
+            json.dump(
+                {"image": imageId, "addr": lineAddr, "idx": lineIdx, "lines": lines},
+                cacheFile,
+            )
+    except IOError:
+        printf("Cannot write line table cache %s\n", cacheName)
+
+    return (lineAddr, lineIdx, lines)
+
+
+def lookupLine(lineTable, pc):
+    # index of the (file, line) entry covering pc, -1 when unknown
+    (lineAddr, lineIdx, lines) = lineTable
+    pos = bisect.bisect_right(lineAddr, pc) - 1
+    if pos < 0:
+        return -1
+    return lineIdx[pos]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# source line profile
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# per line statistics fields (time in csv duration unit)
+LINE_TIME = 0
+LINE_INSTR = 1
+LINE_VEC_LD = 2
+LINE_VEC_ST = 3
+LINE_SCL_LD = 4
+LINE_SCL_ST = 5
+
+# larger gaps between executed lines are not annotated with source
+MAX_LINE_GAP = 8
+
+
+def memAccessType(item):
+    # same classification as the csv per-function counters
+    if vecLDRe.match(item):
+        return LINE_VEC_LD
+    if vecSTRe.match(item):
+        return LINE_VEC_ST
+    if popRe.match(item):
+        return LINE_SCL_LD
+    if pushRe.match(item):
+        return LINE_SCL_ST
+    if sclLDRe.match(item):
+        return LINE_SCL_LD
+    if sclSTRe.match(item):
+        return LINE_SCL_ST
+    return None
+
+
+def readSource(fileName, sourceCache):
+    if fileName not in sourceCache:
+        try:
+            with open(fileName, "r", errors="replace") as src:
+                sourceCache[fileName] = src.read().split("\n")
+        except IOError:
+            sourceCache[fileName] = None
+    return sourceCache[fileName]
+
+
+def writeLineProfile(fileName, lineStats, lineTable):
+    (lineAddr, lineIdx, lines) = lineTable
+    sourceCache = {}
+
+    # group per function
+    funcLines = defaultdict(dict)
+    funcTime = defaultdict(float)
+    for (sym, idx), stats in lineStats.items():
+        funcLines[sym][idx] = stats
+        funcTime[sym] += stats[LINE_TIME]
+    totalTime = sum(funcTime.values())
+
+    try:
+        lineFile = open(fileName, "w")
+    except IOError:
+        printf("Cannot open output file\n")
+        sys.exit(2)
+
+    lineFile.write(
+        "time, time (%), instructions count, Vec LD count, Vec ST count, Sc LD count, Sc ST count, file:line | source\n"
+    )
+
+    for sym in sorted(funcTime, key=lambda x: funcTime[x], reverse=True):
+        lineFile.write(
+            "\n== %s : %f (%.2f %%)\n"
+            % (
+                sym,
+                funcTime[sym],
+                100 * funcTime[sym] / totalTime if totalTime else 0,
+            )
+        )
+
+        # executed lines per source file, unknown lines last
+        perFile = defaultdict(dict)
+        for idx, stats in funcLines[sym].items():
+            (srcName, line) = lines[idx] if idx >= 0 else ("??", 0)
+            perFile[srcName][line] = stats
+
+        for srcName in sorted(perFile, key=lambda x: (x == "??", x)):
+            fileLines = perFile[srcName]
+            source = readSource(srcName, sourceCache) if srcName != "??" else None
+
+            # executed lines, annotated with the source lines in between when the
+            # file is available and the gap is small, line 0 (code without
+            # source line, e.g. compiler generated) reported last
+            lineRange = []
+            for line in sorted(l for l in fileLines if l > 0):
+                if source is not None and lineRange:
+                    if line - lineRange[-1] <= MAX_LINE_GAP:
+                        lineRange += range(lineRange[-1] + 1, line)
+                    else:
+                        lineRange.append(None)
+                lineRange.append(line)
+            if 0 in fileLines:
+                lineRange.append(0)
+
+            for line in lineRange:
+                if line is None:
+                    lineFile.write("%s...\n" % (" " * 70))
+                    continue
+
+                text = ""
+                if source is not None and 0 < line <= len(source):
+                    text = " | " + source[line - 1]
+                lineName = "%s:%d" % (srcName, line) if line else "%s:<no line>" % srcName
+
+                stats = fileLines.get(line)
+                if stats is None:
+                    lineFile.write("%s%s%s\n" % (" " * 70, lineName, text))
+                else:
+                    lineFile.write(
+                        "%12f, %6.2f, %10d, %8d, %8d, %8d, %8d, %s%s\n"
+                        % (
+                            stats[LINE_TIME],
+                            (
+                                100 * stats[LINE_TIME] / funcTime[sym]
+                                if funcTime[sym]
+                                else 0
+                            ),
+                            stats[LINE_INSTR],
+                            stats[LINE_VEC_LD],
+                            stats[LINE_VEC_ST],
+                            stats[LINE_SCL_LD],
+                            stats[LINE_SCL_ST],
+                            lineName,
+                            text,
+                        )
+                    )
+
+    lineFile.close()
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# loop analysis
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# bound on the number of tracked loops per function
+MAX_LOOPS_PER_FUNC = 32
+
+
+def newLoopFunc():
+    # per function state : last visit of each PC during the current
+    # activation (used to recover the first iteration of a newly discovered
+    # loop), discovered loops indexed by header PC and stack of loops being
+    # executed
+    return {"visit": {}, "loops": {}, "active": []}
+
+
+def newLoop(header, latch):
+    return {
+        "header": header,
+        "latch": latch,
+        "kind": "branch",
+        "active": False,
+        "entries": 0,
+        "iters": 0,
+        "time": 0.0,
+        "instr": 0,
+        "vec": 0,
+        "tripMin": 0,
+        "tripMax": 0,
+        # trip count distribution, power of 2 buckets
+        "hist": defaultdict(int),
+        # current entry
+        "trips": 0,
+        # no branch taken since last header execution
+        "straight": False,
+        "entry": (0.0, 0, 0),
+    }
+
+
+# loop statistics are differences of (time, instructions, vector instructions)
+# counters of the execution context, so that called functions are included
+
+
+def openLoop(fn, loop, trips, entry):
+    loop["entry"] = entry
+    loop["trips"] = trips
+    loop["straight"] = False
+    loop["active"] = True
+    fn["active"].append(loop)
+
+
+def closeLoop(loop, now):
+    trips = loop["trips"]
+    if loop["entries"] == 0 or trips < loop["tripMin"]:
+        loop["tripMin"] = trips
+    loop["tripMax"] = max(loop["tripMax"], trips)
+    loop["entries"] += 1
+    loop["iters"] += trips
+    loop["hist"][trips.bit_length()] += 1
+    loop["time"] += now[0] - loop["entry"][0]
+    loop["instr"] += now[1] - loop["entry"][1]
+    loop["vec"] += now[2] - loop["entry"][2]
+    loop["active"] = False
+
+
+def closeAllLoops(fn, now):
+    # function entry or return : end of the activation
+    while fn["active"]:
+        closeLoop(fn["active"].pop(), now)
+    fn["visit"].clear()
+
+
+def trackLoops(fn, pc, pcPrev, backEdge, now, latchKind):
+    # called for each instruction executed by the function, before
+    # the context instruction / vector counts are accumulated
+    # an iteration is counted each time the loop header is executed, except
+    # the final test of top-tested loops : loop left from the header block
+    # (no branch taken since the header) rather than from its latch
+    active = fn["active"]
+    loops = fn["loops"]
+    sequential = 0 <= pc - pcPrev <= 4
+
+    # leaving loop bodies
+    while active and not active[-1]["header"] <= pc <= active[-1]["latch"]:
+        loop = active.pop()
+        if loop["straight"] and pcPrev != loop["latch"] and loop["trips"]:
+            loop["trips"] -= 1
+        closeLoop(loop, now)
+
+    if not sequential:
+        for loop in active:
+            loop["straight"] = False
+
+    loop = loops.get(pc)
+
+    if backEdge and loop is None and len(loops) < MAX_LOOPS_PER_FUNC:
+        # newly discovered loop : entered on the first visit of its body
+        # during this activation (earlier than the header for loops
+        # entered through their bottom condition)
+        visit = fn["visit"]
+        entries = [visit[a] for a in range(pc, pcPrev + 1, 2) if a in visit]
+        loop = newLoop(pc, pcPrev)
+        loops[pc] = loop
+        if entries:
+            openLoop(fn, loop, 1 if pc in visit else 0, min(entries))
+        else:
+            openLoop(fn, loop, 0, now)
+
+    if loop is not None and backEdge:
+        if latchKind is not None:
+            loop["kind"] = latchKind
+        loop["latch"] = max(loop["latch"], pcPrev)
+
+    if loop is None or not loop["active"]:
+        if not sequential or loop is not None:
+            # branch (or fall through to a header) into known loop bodies
+            entered = [
+                l
+                for l in loops.values()
+                if not l["active"] and l["header"] <= pc <= l["latch"]
+            ]
+            # outer loops first
+            entered.sort(key=lambda l: l["latch"] - l["header"], reverse=True)
+            for l in entered:
+                openLoop(fn, l, 0, now)
+
+    if loop is not None:
+        loop["trips"] += 1
+        loop["straight"] = True
+
+    fn["visit"][pc] = now
+
+
+def writeLoopReport(fileName, contexts):
+    try:
+        loopFile = open(fileName, "w")
+    except IOError:
+        printf("Cannot open output file\n")
+        sys.exit(2)
+
+    loopFile.write(
+        "func, header, latch, kind, entries, iterations, trip min, trip max, trip mean, time, time/iter, instructions/iter, vector (%), trip distribution, context\n"
+    )
+
+    loops = [
+        (sym, loop, ctx["name"])
+        for ctx in contexts.values()
+        for sym, fn in ctx["loopState"].items()
+        for loop in fn["loops"].values()
+        if loop["entries"]
+    ]
+    for sym, loop, ctxName in sorted(loops, key=lambda x: x[1]["time"], reverse=True):
+        hist = " ".join(
+            "%d-%d:%d" % (1 << (b - 1), (1 << b) - 1, cnt) if b > 1 else "%d:%d" % (b, cnt)
+            for b, cnt in sorted(loop["hist"].items())
+        )
+        loopFile.write(
+            '%s, %s, %s, %s, %d, %d, %d, %d, %.2f, %f, %f, %.2f, %.2f, "%s", %s\n'
+            % (
+                sym.strip(),
+                hex(loop["header"]),
+                hex(loop["latch"]),
+                loop["kind"],
+                loop["entries"],
+                loop["iters"],
+                loop["tripMin"],
+                loop["tripMax"],
+                loop["iters"] / float(loop["entries"]),
+                loop["time"],
+                loop["time"] / loop["iters"] if loop["iters"] else 0,
+                loop["instr"] / float(loop["iters"]) if loop["iters"] else 0,
+                100 * float(loop["vec"]) / loop["instr"] if loop["instr"] else 0,
+                hist,
+                ctxName,
+            )
+        )
+
+    loopFile.close()
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# execution contexts (one call stack per core and thread / handler mode)
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def branchTarget(item, pc):
+    # None : not a branch, -1 : target not known (register, unsupported syntax)
+    m = branchRe.match(item)
+    if m is None:
+        return None
+    dest = m.group("dest")
+    m = pcRelRe.match(dest)
+    if m:
+        # {pc} : address of the branch instruction (armasm syntax)
+        return (pc + int(m.group("off").replace(" ", ""), 0)) & 0xFFFFFFFE
+    m = absDestRe.match(dest)
+    if m:
+        return int(m.group(1), 16) & 0xFFFFFFFE
+    return -1
+
+
+def newTraceContext(core, mode, level, tid, symArr, outTyp):
+    # level : exception nesting level of handler contexts
+    emptyList = [0] * len(symArr)
+    ctx = {
+        "name": "%s %s %d" % (core, mode, level) if level else "%s %s" % (core, mode),
+        "mode": mode,
+        "tid": tid,
+        # handler returned from its outermost function
+        "excReturn": False,
+        # target of last instruction when it is a branch
+        "branch": None,
+        "stack": [],
+        "prevSym": "",
+        "prevSymb": (0, 0, None, set()),
+        "pcPrev": 0,
+        "prevClock": 0,
+        "prevLine": -1,
+        "latchKind": None,
+        # time spent in other contexts of the same core, and preemption start
+        "preempted": 0,
+        "preemptSince": None,
+        "funcTrack": dict(zip(symArr, emptyList)),
+        "funcPreemptTrack": dict(zip(symArr, emptyList)),
+        "loopState": defaultdict(newLoopFunc),
+        # instructions executed in this context (loop analysis)
+        "instr": 0,
+        "vec": 0,
+    }
+    if outTyp == "csv":
+        # extended memory statistics structure when csv output is selected
+        for track in (
+            "funcIOReadTrack",
+            "funcIOWriteTrack",
+            "funcLDTrack",
+            "funcSTTrack",
+            "funcInstrCntTrack",
+            "funcVecLDTrack",
+            "funcVecSTTrack",
+            "funcSclLDTrack",
+            "funcSclSTTrack",
+            "IFetchTrack",
+        ):
+            ctx[track] = dict(zip(symArr, emptyList))
+    return ctx
+
+
+def unwindStack(ctx, target, clock, timeScale, outFile, outTyp, funcTotalTime, loops):
+    # return from the functions stacked above target (whole stack when None)
+    stack = ctx["stack"]
+    funcTrack = ctx["funcTrack"]
+
+    while stack:
+        prevSym = stack.pop()
+
+        if prevSym == target:
+            break
+
+        if verbose:
+            printf("%s is returning\n", prevSym)
+
+        if loops:
+            closeAllLoops(
+                ctx["loopState"][prevSym],
+                ((clock - ctx["preempted"]) / timeScale, ctx["instr"], ctx["vec"]),
+            )
+
+        if funcTrack[prevSym] == 0:
+            # force 0 (2 consecutive ret)
+            continue
+
+        diff = clock - funcTrack[prevSym]
+        # time spent in other contexts (ISR) is not charged to the function
+        preempted = ctx["preempted"] - ctx["funcPreemptTrack"][prevSym]
+        funcTotalTime[prevSym] += (diff - preempted) / timeScale
+
+        if outTyp == "json":
+            if preempted:
+                args = '{"preempted": %.10f}' % (preempted / timeScale)
+            else:
+                args = "{}"
+            outFile.write(
+                '{"name": "%s", "cat": "arm", "ph": "X", "ts": %.10f, "dur": %.10f, "pid": %d, "tid": %d,  "args": %s},\n'
+                % (
+                    prevSym,
+                    funcTrack[prevSym] / timeScale,
+                    diff / timeScale,
+                    1,
+                    ctx["tid"],
+                    args,
+                )
+            )
+        else:
+            outFile.write(
+                "%s, %f, %f, %d, %d, %d, %d, %d, %d, %d, %d, %d, %d, %f, %s\n"
+                % (
+                    prevSym.strip(),
+                    funcTrack[prevSym] / timeScale,
+                    (diff - preempted) / timeScale,
+                    ctx["funcInstrCntTrack"][prevSym],
+                    ctx["funcLDTrack"][prevSym],
+                    ctx["funcSTTrack"][prevSym],
+                    ctx["funcVecLDTrack"][prevSym],
+                    ctx["funcVecSTTrack"][prevSym],
+                    ctx["funcSclLDTrack"][prevSym],
+                    ctx["funcSclSTTrack"][prevSym],
+                    ctx["IFetchTrack"][prevSym],
+                    ctx["funcIOReadTrack"][prevSym],
+                    ctx["funcIOWriteTrack"][prevSym],
+                    preempted / timeScale,
+                    ctx["name"],
+                )
+            )
+
+        funcTrack[prevSym] = 0
+
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # usage message
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -126,13 +1145,20 @@ def usage():
 
     printf(
         """
-\033[4musage\033[0m : \033[31;1m arm_tarmac_2_chrometracing.py\033[00m image.sym tarmac.log out.[json|csv]
+\033[4musage\033[0m : \033[31;1m arm_tarmac_2_chrometracing.py\033[00m [options] image.sym tarmac.log out.[json|csv]
 """
     )
     printf(" where : \n")
     printf(" image.sym          : image symbols (fromelf -s)\n")
     printf(" tarmac.log         : tarmac output\n")
     printf(" out.[json|csv]     : processed csv or chrome tracing output\n")
+    printf(" options : \n")
+    printf(" --follow           : tail a growing tarmac file or named pipe (CTRL+C to stop)\n")
+    printf(" --refresh sec      : live snapshot refresh period (default 5s)\n")
+    printf(" --snapshot file    : live snapshot file (default snapshot)\n")
+    printf(" --http port        : serve live snapshot on http://127.0.0.1:port/\n")
+    printf(" --axf image.axf    : source line profiling from image DWARF line table\n")
+    printf(" --loops            : loop analysis (trip counts, time per iteration)\n")
     exit(2)
 
 
@@ -158,26 +1184,63 @@ def main(argv):
     T32_INST_MIN_SIZE = 2
     partialFromelfEntry = ""
 
+    # live follow mode
+    follow = False
+    refreshPeriod = 5.0
+    snapshotName = "snapshot"
+    httpPort = None
+
+    # source line profiling
+    axfName = None
+    lineTable = None
+
+    # loop analysis
+    loops = False
+
     printf("ARM tarmac to chrome tracing converter\n")
 
-    if len(sys.argv) != 4:
+    # options
+    args = []
+    argIt = iter(argv)
+    try:
+        for arg in argIt:
+            if arg == "--follow":
+                follow = True
+            elif arg == "--refresh":
+                refreshPeriod = float(next(argIt))
+            elif arg == "--snapshot":
+                snapshotName = next(argIt)
+            elif arg == "--http":
+                httpPort = int(next(argIt))
+            elif arg == "--axf":
+                axfName = next(argIt)
+            elif arg == "--loops":
+                loops = True
+            elif arg.startswith("--"):
+                usage()
+            else:
+                args.append(arg)
+    except (StopIteration, ValueError):
+        usage()
+
+    if len(args) != 3:
         usage()
 
     try:
-        axfImage = open(sys.argv[1], "r")
+        axfImage = open(args[0], "r")
     except IOError:
         printf("Cannot open symbol file\n")
         sys.exit(2)
 
-    pcLog = sys.argv[2]
+    pcLog = args[1]
 
-    if "json" in sys.argv[3]:
+    if "json" in args[2]:
         outTyp = "json"
     else:
         outTyp = "csv"
 
     try:
-        outFile = open(sys.argv[3], "w")
+        outFile = open(args[2], "w")
     except IOError:
         printf("Cannot open output file\n")
         sys.exit(2)
@@ -243,23 +1306,29 @@ def main(argv):
                 nbSym += 1
                 continue
 
+    if axfName is not None:
+        try:
+            lineTable = buildLineTable(axfName)
+        except IOError:
+            printf("Cannot open image file\n")
+            sys.exit(2)
+        except (ValueError, IndexError, struct.error):
+            printf("cannot decode .debug_line, line profiling disabled\n")
+            lineTable = None
+        if lineTable is not None:
+            printf("%d source lines for %d addresses\n", len(lineTable[2]), len(lineTable[0]))
+            lineStats = defaultdict(lambda: [0.0, 0, 0, 0, 0, 0])
+
     emptyList = [0] * nbSym
-    funcTrack = dict(zip(symArr, emptyList))
-    if outTyp == "csv":
-        # extended memory statistics structure when csv output is selected
-        funcIOReadTrack = dict(zip(symArr, emptyList))
-        funcIOWriteTrack = dict(zip(symArr, emptyList))
-        funcLDTrack = dict(zip(symArr, emptyList))
-        funcSTTrack = dict(zip(symArr, emptyList))
-        funcInstrCntTrack = dict(zip(symArr, emptyList))
-        funcVecLDTrack = dict(zip(symArr, emptyList))
-        funcVecSTTrack = dict(zip(symArr, emptyList))
-        funcSclLDTrack = dict(zip(symArr, emptyList))
-        funcSclSTTrack = dict(zip(symArr, emptyList))
-        IFetchTrack = dict(zip(symArr, emptyList))
 
+    # flat profile aggregates
+    funcCallCnt = dict(zip(symArr, emptyList))
+    funcSelfTime = dict(zip(symArr, emptyList))
+    funcTotalTime = dict(zip(symArr, emptyList))
+    funcTotalInstr = dict(zip(symArr, emptyList))
+    if outTyp == "csv":
         outFile.write(
-            "function, start time, duration, instructions count, DTCM LD, DTCM ST, Vec LD count, Vec ST count, Sc LD count, Sc ST count, I Fetch Count, IO Read, IO Write\n"
+            "function, start time, duration, instructions count, DTCM LD, DTCM ST, Vec LD count, Vec ST count, Sc LD count, Sc ST count, I Fetch Count, IO Read, IO Write, preempted, context\n"
         )
         if (
             PipeTraceStr[parsePipeTraceReIdx] == "PipeMod"
@@ -267,10 +1336,22 @@ def main(argv):
         ):
             printf("/!\ statistics are not reliable on SW model\n")
 
-    pcLogFile = open(pcLog, "r")
+    if follow:
+        # trace size is unknown, progress is reported through the live snapshot
+        pcLogFile = followLines(pcLog)
+        count = 0
+        printf("Follow %s\n", pcLog)
+
+        prevSelfTime = {}
+        snapCount = 0
+        nextRefresh = time.time() + refreshPeriod
+        if httpPort is not None:
+            startSnapshotServer(httpPort)
+    else:
+        pcLogFile = open(pcLog, "r")
 
-    count = sum(1 for line in open(pcLog))
-    printf("Process %d instructions\n", count)
+        count = sum(1 for line in open(pcLog))
+        printf("Process %d instructions\n", count)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # track function coverage
@@ -280,28 +1361,72 @@ def main(argv):
     limitHit = 0
     pcCount = 0
     nextPercStep = 0
-    pcPrev = 0
     clock = 0
-    stack = []
-    prevSymb = (0, 0, None, set())
+
+    # execution contexts indexed by (core, mode) and context running on each core
+    traceCtx = False
+    contexts = {}
+    coreCtx = {}
+    ctxKey = None
+    curCtx = None
+
+    # exception nesting level per core (-1 in thread mode)
+    hdlrLevel = {}
+    handlerEntries = set(
+        base & 0xFFFFFFFE for base, size, sym, myset in symbArray if handlerRe.match(sym.strip())
+    )
 
     for item in pcLogFile:
-        if limitHit:
-            update_progress(100)
-            printf("\n")
-            break
+        if follow:
+            # refresh live snapshot (wall clock checked every 4K lines or when idle)
+            # window statistics cover the lines received since previous refresh
+            if (
+                (item is None or pcCount & 0xFFF == 0)
+                and pcCount != snapCount
+                and time.time() >= nextRefresh
+            ):
+                writeSnapshot(
+                    snapshotName,
+                    formatSnapshot(
+                        funcCallCnt,
+                        funcSelfTime,
+                        funcTotalTime,
+                        funcTotalInstr,
+                        prevSelfTime,
+                        codecov_dict,
+                        pcCount,
+                        clock / timeScale,
+                    ),
+                )
+                prevSelfTime = dict(funcSelfTime)
+                snapCount = pcCount
+                nextRefresh = time.time() + refreshPeriod
 
-        if abort:
-            printf("Abort after %0.1f %%\n", curPerc)
-            break
+            if abort:
+                printf("Stop following after %d lines\n", pcCount)
+                break
+
+            if item is None:
+                continue
+
+            pcCount += 1
+        else:
+            if limitHit:
+                update_progress(100)
+                printf("\n")
+                break
 
-        curPerc = int(pcCount / float(count) * 100.0)
-        pcCount += 1
+            if abort:
+                printf("Abort after %0.1f %%\n", curPerc)
+                break
 
-        # progress bar
-        if curPerc >= nextPercStep:
-            update_progress(curPerc)
-            nextPercStep += 1
+            curPerc = int(pcCount / float(count) * 100.0)
+            pcCount += 1
+
+            # progress bar
+            if curPerc >= nextPercStep:
+                update_progress(curPerc)
+                nextPercStep += 1
 
         # trace format discovery
         if not parsePipeTraceReFound:
@@ -313,6 +1438,7 @@ def main(argv):
                 else:
                     parsePipeTraceReFound = True
                     timeScale = pipeTraceScal[parsePipeTraceReIdx]
+                    traceCtx = "mode" in parsePipeTraceRe[parsePipeTraceReIdx].groupindex
                     if verbose:
                         printf(
                             "found trace format %s scale %d\n",
@@ -330,9 +1456,137 @@ def main(argv):
 
         m = parsePipeTraceRe[parsePipeTraceReIdx].match(item)
         if m:
-            clock = float(m.group(1))
-            pc = int(m.group(2), 16)
-            instr = m.group(3)
+            clock = float(m.group("time"))
+            pc = int(m.group("pc"), 16)
+            instr = m.group("instr")
+
+            # execution context switch
+            # handler contexts are split per exception nesting level, a new
+            # exception being detected on entry of a *Handler function which
+            # is not reached by a branch (handler calling a *Handler function)
+            excExit = None
+            if traceCtx:
+                core = m.group("cpu")
+                level = hdlrLevel.get(core, -1)
+                if m.group("mode") == "hdlr":
+                    if level < 0:
+                        # exception taken from thread mode
+                        level = 0
+                    else:
+                        top = contexts[(core, "hdlr", level)]
+                        if pc in handlerEntries:
+                            if top["excReturn"]:
+                                # tail chaining : previous handler completed
+                                excExit = [top]
+                            elif top["branch"] is not None and top["branch"] in (-1, pc):
+                                # function call from current handler
+                                pass
+                            else:
+                                # nested exception preempting current handler
+                                level += 1
+                        elif top["excReturn"] and level > 0:
+                            # return from nested exception
+                            excExit = [top]
+                            level -= 1
+                    newKey = (core, "hdlr", level)
+                else:
+                    if level >= 0:
+                        # exception return : all handler levels are completed
+                        excExit = [contexts[(core, "hdlr", l)] for l in range(level, -1, -1)]
+                        level = -1
+                    newKey = (core, "thread")
+                hdlrLevel[core] = level
+            else:
+                core = ""
+                newKey = (core, "thread")
+
+            if newKey != ctxKey or excExit is not None:
+                if curCtx is not None:
+                    curCtx["prevSym"] = prevSym
+                    curCtx["prevSymb"] = prevSymb
+                    curCtx["pcPrev"] = pcPrev
+                    curCtx["prevClock"] = prevClock
+                    curCtx["prevLine"] = prevLine
+                    curCtx["latchKind"] = latchKind
+
+                ctxKey = newKey
+                curCtx = contexts.get(ctxKey)
+                if curCtx is None:
+                    curCtx = newTraceContext(
+                        core or "cpu",
+                        ctxKey[1],
+                        ctxKey[2] if len(ctxKey) > 2 else 0,
+                        len(contexts) + 1,
+                        symArr,
+                        outTyp,
+                    )
+                    contexts[ctxKey] = curCtx
+                    if outTyp == "json":
+                        outFile.write(
+                            '{"name": "thread_name", "ph": "M", "ts": 0, "pid": 1, "tid": %d, "args": {"name": "%s"}},\n'
+                            % (curCtx["tid"], curCtx["name"])
+                        )
+
+                # preemption or exception return on this core
+                outCtx = coreCtx.get(core)
+                coreCtx[core] = curCtx
+                if outCtx is not None and (outCtx is not curCtx or excExit is not None):
+                    # last instruction of the context being left runs until now
+                    if outCtx["prevSym"] != "":
+                        funcSelfTime[outCtx["prevSym"]] += (
+                            clock - outCtx["prevClock"]
+                        ) / timeScale
+                        if lineTable is not None:
+                            lineStats[(outCtx["prevSym"].strip(), outCtx["prevLine"])][
+                                LINE_TIME
+                            ] += (clock - outCtx["prevClock"]) / timeScale
+
+                    if excExit is not None:
+                        # exception return : handler functions are all returning
+                        for excCtx in excExit:
+                            unwindStack(
+                                excCtx,
+                                None,
+                                clock,
+                                timeScale,
+                                outFile,
+                                outTyp,
+                                funcTotalTime,
+                                loops,
+                            )
+                            excCtx["prevSym"] = ""
+                            excCtx["pcPrev"] = 0
+                            excCtx["excReturn"] = False
+                            excCtx["branch"] = None
+                            excCtx["preemptSince"] = None
+                    else:
+                        outCtx["preemptSince"] = clock
+
+                    if curCtx["preemptSince"] is not None:
+                        curCtx["preempted"] += clock - curCtx["preemptSince"]
+                        curCtx["preemptSince"] = None
+                    curCtx["prevClock"] = clock
+
+                prevSym = curCtx["prevSym"]
+                prevSymb = curCtx["prevSymb"]
+                pcPrev = curCtx["pcPrev"]
+                prevClock = curCtx["prevClock"]
+                prevLine = curCtx["prevLine"]
+                latchKind = curCtx["latchKind"]
+                stack = curCtx["stack"]
+                funcTrack = curCtx["funcTrack"]
+                loopState = curCtx["loopState"]
+                if outTyp == "csv":
+                    funcIOReadTrack = curCtx["funcIOReadTrack"]
+                    funcIOWriteTrack = curCtx["funcIOWriteTrack"]
+                    funcLDTrack = curCtx["funcLDTrack"]
+                    funcSTTrack = curCtx["funcSTTrack"]
+                    funcInstrCntTrack = curCtx["funcInstrCntTrack"]
+                    funcVecLDTrack = curCtx["funcVecLDTrack"]
+                    funcVecSTTrack = curCtx["funcVecSTTrack"]
+                    funcSclLDTrack = curCtx["funcSclLDTrack"]
+                    funcSclSTTrack = curCtx["funcSclSTTrack"]
+                    IFetchTrack = curCtx["IFetchTrack"]
 
             dbg_mrkr = " ".join(re.split("\s+", item)[-3:])
 
@@ -357,10 +1611,43 @@ def main(argv):
                     codecov_dict[sym.strip()][0][hex(pc)] += 1
                     codecov_dict[sym.strip()][2].add((hex(pc), len(instr) / 2))
 
+                    # flat profile : time elapsed since previous instruction
+                    # is charged to the function which executed it
+                    if prevSym != "":
+                        funcSelfTime[prevSym] += (clock - prevClock) / timeScale
+                        if lineTable is not None:
+                            lineStats[(prevSym.strip(), prevLine)][LINE_TIME] += (
+                                clock - prevClock
+                            ) / timeScale
+                    prevClock = clock
+                    funcTotalInstr[sym] += 1
+                    backEdge = sym == prevSym and pc < pcPrev
+
+                    if lineTable is not None:
+                        prevLine = lookupLine(lineTable, pc)
+                        stats = lineStats[(sym.strip(), prevLine)]
+                        # skip 2nd beat
+                        if "[--cc]" not in item:
+                            stats[LINE_INSTR] += 1
+                        memType = memAccessType(item)
+                        if memType is not None:
+                            stats[memType] += 1
+
                     # function start (relative offset = 0)
                     if offset < 2:
                         # function start detection (PC offset = 0)
                         funcTrack[sym] = clock
+                        curCtx["funcPreemptTrack"][sym] = curCtx["preempted"]
+                        funcCallCnt[sym] += 1
+                        if loops:
+                            closeAllLoops(
+                                loopState[sym],
+                                (
+                                    (clock - curCtx["preempted"]) / timeScale,
+                                    curCtx["instr"],
+                                    curCtx["vec"],
+                                ),
+                            )
                         if outTyp == "csv":
                             funcIOReadTrack[sym] = 0
                             funcIOWriteTrack[sym] = 0
@@ -389,54 +1676,9 @@ def main(argv):
                         if verbose:
                             printf("%% %s %%\n", sym)
                         if sym in stack:
-                            while True:
-                                item = stack.pop()
-
-                                if item == sym:
-                                    break
-
-                                prevSym = item
-                                if verbose:
-                                    printf("%s is returning\n", prevSym)
-
-                                if funcTrack[prevSym] == 0:
-                                    # force 0 (2 consecutive ret)
-                                    diff = 0
-                                else:
-                                    diff = clock - funcTrack[prevSym]
-
-                                    if outTyp == "json":
-                                        outFile.write(
-                                            '{"name": "%s", "cat": "arm", "ph": "X", "ts": %.10f, "dur": %.10f, "pid": %d, "tid": %d,  "args": {}},\n'
-                                            % (
-                                                prevSym,
-                                                funcTrack[prevSym] / timeScale,
-                                                diff / timeScale,
-                                                1,
-                                                1,
-                                            )
-                                        )
-                                    else:
-                                        outFile.write(
-                                            "%s, %f, %f, %d, %d, %d, %d, %d, %d, %d, %d, %d, %d\n"
-                                            % (
-                                                prevSym.strip(),
-                                                funcTrack[prevSym] / timeScale,
-                                                diff / timeScale,
-                                                funcInstrCntTrack[prevSym],
-                                                funcLDTrack[prevSym],
-                                                funcSTTrack[prevSym],
-                                                funcVecLDTrack[prevSym],
-                                                funcVecSTTrack[prevSym],
-                                                funcSclLDTrack[prevSym],
-                                                funcSclSTTrack[prevSym],
-                                                IFetchTrack[prevSym],
-                                                funcIOReadTrack[prevSym],
-                                                funcIOWriteTrack[prevSym],
-                                            )
-                                        )
-
-                                    funcTrack[prevSym] = 0
+                            unwindStack(
+                                curCtx, sym, clock, timeScale, outFile, outTyp, funcTotalTime, loops
+                            )
 
                         stack.append(sym)
                         if verbose:
@@ -446,6 +1688,34 @@ def main(argv):
                             if stack.count(i) > 1 and verbose:
                                 printf("Warning : duplicate elts in stack\n\n")
 
+                    if loops:
+                        # loop time excludes time spent in other contexts
+                        trackLoops(
+                            loopState[sym],
+                            pc,
+                            pcPrev,
+                            backEdge,
+                            (
+                                (clock - curCtx["preempted"]) / timeScale,
+                                curCtx["instr"],
+                                curCtx["vec"],
+                            ),
+                            latchKind,
+                        )
+                        # skip 2nd beat
+                        if "[--cc]" not in item:
+                            curCtx["instr"] += 1
+                            if vecInstRe.match(item):
+                                curCtx["vec"] += 1
+                        m = loopEndRe.match(item)
+                        latchKind = m.group(1) if m else None
+
+                    if curCtx["mode"] == "hdlr":
+                        curCtx["excReturn"] = (
+                            len(stack) == 1 and excReturnRe.match(item) is not None
+                        )
+                        curCtx["branch"] = branchTarget(item, pc)
+
                     pcPrev = pc
                     prevSym = sym
                     break
@@ -537,19 +1807,7 @@ def main(argv):
     covFile.write("func, size, size covered, coverage (%), inst\n")
     for key, value in codecov_dict.items():
         if bool(value[2]):
-            cov = 0
-            t16 = 0
-            t32 = 0
-
-            for pc, s in value[2]:
-                if s == 2:
-                    cov += 2
-                    t16 += 1
-                elif s == 4:
-                    cov += 4
-                    t32 += 1
-                else:
-                    print(f"error len={s}")
+            (cov, t16, t32) = coverageStats(value[2])
             if value[1] > 8:
                 covFile.write(
                     '%s, %d, %d, %.2f, %d, (%d, %d), "'
@@ -581,6 +1839,34 @@ def main(argv):
                     covFile.write("..no details..")
                 covFile.write('"\n')
 
+    if lineTable is not None:
+        writeLineProfile("lineprofile", lineStats, lineTable)
+
+    if loops:
+        # loops still running at the end of the trace
+        for ctx in contexts.values():
+            for fn in ctx["loopState"].values():
+                closeAllLoops(
+                    fn, ((clock - ctx["preempted"]) / timeScale, ctx["instr"], ctx["vec"])
+                )
+        writeLoopReport("loops", contexts)
+
+    # final live snapshot
+    if follow:
+        writeSnapshot(
+            snapshotName,
+            formatSnapshot(
+                funcCallCnt,
+                funcSelfTime,
+                funcTotalTime,
+                funcTotalInstr,
+                prevSelfTime,
+                codecov_dict,
+                pcCount,
+                clock / timeScale,
+            ),
+        )
+
 
 if __name__ == "__main__":
     main(sys.argv[1:])